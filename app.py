@@ -1,13 +1,18 @@
+import math
+
 import streamlit as st
 import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
 
+from airflow_kernel import superpose
+
 # --- STANDARDS & LIMITS ---
 SS_553_MIN_ACH = 20
 SP_APPROVED_LOAD_KVA = 1120          # total building load limit
 DEFAULT_OTHER_LOAD_KW = 1000          # typical other loads (lighting, outlets, etc.) – user adjustable
+FT3_PER_M3 = 35.3147
 
 # --- FAN DATABASE (from RFI document) ---
 FAN_DATABASE = {
@@ -84,6 +89,21 @@ PROJECT_SCENARIOS = {
     }
 }
 
+# Design notes from the RFI, shown under "Recommendations from RFI"
+RFI_RECOMMENDATIONS = [
+    "The location of HVLS fan shall be reviewed in conjunction with the lighting layout to prevent any throbbing effect.",
+    "Fan and lighting location shall not overlap.",
+    "Location and height to be reviewed and approved with architect.",
+    "6-blade fans consume less power than 8-blade fans.",
+    "SP load upgrading may be required if total building load exceeds 1120 kVA.",
+]
+
+# Shared style of the velocity heatmaps; the colour range is fixed at 0-3 m/s.
+VELOCITY_ZMAX = 3
+VELOCITY_HEATMAP_STYLE = dict(
+    colorscale='Viridis', zmin=0, zmax=VELOCITY_ZMAX, zsmooth='best', colorbar=dict(title="m/s")
+)
+
 st.set_page_config(page_title="SG Hawker Airflow Pro - Optimised", layout="wide")
 
 # --- SIDEBAR ---
@@ -138,17 +158,25 @@ height = st.sidebar.number_input("Ceiling Height (m)", 3, 10, 5)
 st.sidebar.header("📍 Layout Shape")
 shape_type = st.sidebar.radio("Layout Shape", ["Regular (Rectangular)", "Custom L-Shape", "Composite"])
 
+# The shape sliders are batched in a form: adjusting several of them costs one
+# rerun (and one simulation) on submit instead of one per slider change. The
+# shape choice and site dimensions stay outside it, since they decide which
+# sliders are shown and their ranges.
 params = {}
-if shape_type == "Custom L-Shape":
-    params['cw'] = st.sidebar.slider("Cutout Width (m)", 0, int(width-2), 12)
-    params['cl'] = st.sidebar.slider("Cutout Length (m)", 0, int(length-2), 16)
-elif shape_type == "Composite":
-    st.sidebar.subheader("Composite Components")
-    params['rect_w'] = st.sidebar.slider("Main Rectangle Width (m)", 5, int(width), 20)
-    params['rect_l'] = st.sidebar.slider("Main Rectangle Length (m)", 5, int(length), 30)
-    params['tri_base'] = st.sidebar.slider("Triangle Base (m)", 0, int(width), 15)
-    params['tri_height'] = st.sidebar.slider("Triangle Height (m)", 0, int(length), 10)
-    params['circ_r'] = st.sidebar.slider("Circle Radius (m)", 0, int(min(width, length)/2), 8)
+if shape_type != "Regular (Rectangular)":
+    with st.sidebar.form("shape_params"):
+        if shape_type == "Custom L-Shape":
+            params['cw'] = st.slider("Cutout Width (m)", 0, int(width-2), 12)
+            params['cl'] = st.slider("Cutout Length (m)", 0, int(length-2), 16)
+        elif shape_type == "Composite":
+            st.subheader("Composite Components")
+            params['rect_w'] = st.slider("Main Rectangle Width (m)", 5, int(width), 20)
+            params['rect_l'] = st.slider("Main Rectangle Length (m)", 5, int(length), 30)
+            params['tri_base'] = st.slider("Triangle Base (m)", 0, int(width), 15)
+            params['tri_height'] = st.slider("Triangle Height (m)", 0, int(length), 10)
+            params['circ_r'] = st.slider("Circle Radius (m)", 0, int(min(width, length)/2), 8)
+
+        st.form_submit_button("Run Simulation")
 
 st.sidebar.header("📷 Actual Area Image")
 uploaded_image = st.sidebar.file_uploader("Upload floor plan photo", type=['png', 'jpg', 'jpeg'])
@@ -166,32 +194,70 @@ st.sidebar.markdown(
     """, unsafe_allow_html=True
 )
 
-# --- SIMULATION ENGINE (unchanged) ---
-def run_simulation(w, l, h, fan_configs, shape, p):
-    x = np.linspace(0, w, int(w))
-    y = np.linspace(0, l, int(l))
-    X, Y = np.meshgrid(x, y)
-    V = np.zeros_like(X)
-
-    mask = np.full(X.shape, np.nan)
+# --- SIMULATION ENGINE ---
+# Grid points per axis for the velocity field: ~0.8 m spacing, clamped to 24-64
+# points. The heatmap can't show more detail than that, and the grid no longer
+# grows with the site size.
+def grid_points(extent):
+    return min(64, max(24, int(extent / 0.8)))
+
+# Fans are laid out on a near-square grid of rows x cols cells, one fan per cell centre.
+def fan_positions(n, w, l):
+    rows = max(1, math.isqrt(n))
+    cols = max(1, (n // rows) + (1 if n % rows != 0 else 0))
+    idx = np.arange(n)
+    return (idx % cols + 0.5) * (w / cols), (idx // cols + 0.5) * (l / rows)
+
+# Whether each grid point lies inside the layout. X and Y are coordinate
+# arrays that broadcast together.
+def layout_mask(X, Y, w, l, shape, p):
     if shape == "Regular (Rectangular)":
-        mask[:, :] = 1
+        return np.ones(np.broadcast(X, Y).shape, dtype=bool)
     elif shape == "Custom L-Shape":
-        mask_logic = ~((X > (w - p['cw'])) & (Y > (l - p['cl'])))
-        mask[mask_logic] = 1
+        return ~((X > (w - p['cw'])) & (Y > (l - p['cl'])))
     elif shape == "Composite":
         rect = (X <= p['rect_w']) & (Y <= p['rect_l'])
         tri = (X <= p['tri_base']) & (Y > p['rect_l']) & (Y <= p['rect_l'] + p['tri_height'])
         dist_from_center = np.sqrt((X - p['rect_w'])**2 + (Y - (p['rect_l']/2))**2)
         circ = dist_from_center <= p['circ_r']
-        mask_logic = rect | tri | circ
-        mask[mask_logic] = 1
+        return rect | tri | circ
+    return np.zeros(np.broadcast(X, Y).shape, dtype=bool)
+
+# The layout on the original one-point-per-metre grid. Fan placement and the
+# composite floor area are evaluated on it, so the compliance figures don't
+# depend on the display grid.
+def site_mask(w, l, shape, p):
+    x = np.linspace(0, w, int(w))
+    y = np.linspace(0, l, int(l))
+    return layout_mask(x[None, :], y[:, None], w, l, shape, p)
 
-    net_area = np.nansum(mask)
+# Net floor area from the layout geometry. The composite union has no simple
+# closed form, so it is counted on the 1 m site grid.
+def layout_area(w, l, shape, p, site):
+    if shape == "Regular (Rectangular)":
+        return w * l
+    elif shape == "Custom L-Shape":
+        return w * l - p['cw'] * p['cl']
+    return np.count_nonzero(site)
+
+# Cached so reruns triggered by widgets that don't affect the geometry or fan
+# layout (power budget, overlay toggle, buttons) skip the simulation entirely.
+@st.cache_data(show_spinner=False, max_entries=32)
+def run_simulation(w, l, h, fan_configs, shape, **p):
+    x = np.linspace(0, w, grid_points(w), dtype=np.float32)
+    y = np.linspace(0, l, grid_points(l), dtype=np.float32)
+    # (1, nx) / (ny, 1) views broadcast to the full grid in the mask tests.
+    X, Y = x[None, :], y[:, None]
+
+    mask = layout_mask(X, Y, w, l, shape, p)
+
+    site = site_mask(w, l, shape, p)
+    net_area = layout_area(w, l, shape, p, site)
     volume_m3 = net_area * h
-    volume_ft3 = volume_m3 * 35.3147
+    volume_ft3 = volume_m3 * FT3_PER_M3
 
     placed_fans = []
+    fan_x, fan_y, fan_strength, fan_inv_scale = [], [], [], []
     total_airflow_cfm = 0
     total_power_w = 0
 
@@ -200,34 +266,49 @@ def run_simulation(w, l, h, fan_configs, shape, p):
         quantity = config["quantity"]
         fan_data = FAN_DATABASE[model]
 
-        rows = int(np.sqrt(quantity))
-        cols = (quantity // rows) + (1 if quantity % rows != 0 else 0)
-
         r_eff = fan_data["diameter"] / 2
         strength = fan_data["cfm"] / 20000
 
-        placed = 0
-        for i in range(quantity):
-            fx = (i % cols + 0.5) * (w / cols)
-            fy = (i // cols + 0.5) * (l / rows)
+        fx, fy = fan_positions(quantity, w, l)
+        ix = np.minimum(fx, w - 1).astype(int)
+        iy = np.minimum(fy, l - 1).astype(int)
+        inside = site[iy, ix]
+        fx, fy = fx[inside], fy[inside]
+        placed = fx.size
 
-            ix, iy = int(min(fx, w-1)), int(min(fy, l-1))
-            if not np.isnan(mask[iy, ix]):
-                placed += 1
-                dist = np.sqrt((X - fx)**2 + (Y - fy)**2)
-                V += strength * np.exp(-dist / (r_eff * 1.5))
-                placed_fans.append({"model": model, "x": fx, "y": fy})
+        fan_x.append(fx)
+        fan_y.append(fy)
+        fan_strength.append(np.full(placed, strength, dtype=np.float32))
+        fan_inv_scale.append(np.full(placed, 1.0 / (r_eff * 1.5), dtype=np.float32))
+        placed_fans.append({"model": model, "x": fx, "y": fy})
 
         total_airflow_cfm += fan_data["cfm"] * placed
         total_power_w += fan_data["power_w"] * placed
 
+    V = superpose(x, y, np.concatenate(fan_x, dtype=np.float32),
+                  np.concatenate(fan_y, dtype=np.float32),
+                  np.concatenate(fan_strength), np.concatenate(fan_inv_scale),
+                  np.empty(mask.shape, dtype=np.float32))
+    # Cells outside the layout are NaN so the heatmaps leave them blank.
+    V[~mask] = np.nan
+
     ach = (total_airflow_cfm * 60) / volume_ft3 if volume_ft3 > 0 else 0
-    return X, Y, V * mask, net_area, volume_m3, placed_fans, total_airflow_cfm, total_power_w, ach
+    return x, y, V, net_area, volume_m3, placed_fans, total_airflow_cfm, total_power_w, ach
+
+# Cached as a resource (the figure object itself, not a copy) so reruns that
+# don't change the simulation inputs skip rebuilding and validating the traces.
+@st.cache_resource(show_spinner=False, max_entries=32)
+def build_heatmap_figure(w, l, h, fan_configs, shape, **p):
+    x, y, V = run_simulation(w, l, h, fan_configs, shape, **p)[:3]
+    fig = go.Figure(data=go.Heatmap(z=V, x=x, y=y, **VELOCITY_HEATMAP_STYLE))
+    fig.update_layout(title="Airflow Velocity Distribution", height=600)
+    return fig
 
 # --- EXECUTION ---
-X, Y, V, actual_area, volume, placed_fans, total_cfm, total_power, ach = run_simulation(
-    width, length, height, fan_configs, shape_type, params
+x_axis, y_axis, V, actual_area, volume, placed_fans, total_cfm, total_power, ach = run_simulation(
+    width, length, height, fan_configs, shape_type, **params
 )
+total_power_kw = total_power / 1000
 
 # --- DISPLAY RESULTS ---
 st.title(f"🇸🇬 Airflow Simulation: Tanglin Halt Hawker Centre")
@@ -237,7 +318,7 @@ c1, c2, c3, c4 = st.columns(4)
 c1.metric("Effective Floor Area", f"{actual_area:.1f} m²")
 c2.metric("Volume", f"{volume:.1f} m³")
 c3.metric("Calculated ACH", f"{ach:.1f}", delta=f"{ach - SS_553_MIN_ACH:.1f}")
-c4.metric("Total Fan Power", f"{total_power/1000:.2f} kW")
+c4.metric("Total Fan Power", f"{total_power_kw:.2f} kW")
 
 if ach < SS_553_MIN_ACH:
     st.error(f"⚠️ Airflow non‑compliant ({ach:.1f} ACH).")
@@ -245,8 +326,8 @@ else:
     st.success("✅ Airflow meets SS 553.")
 
 # Power compliance
-if total_power/1000 > max_fan_power_kw:
-    st.error(f"⚠️ Fan power ({total_power/1000:.2f} kW) exceeds available budget ({max_fan_power_kw:.2f} kW). Reduce fans or increase other load estimate.")
+if total_power_kw > max_fan_power_kw:
+    st.error(f"⚠️ Fan power ({total_power_kw:.2f} kW) exceeds available budget ({max_fan_power_kw:.2f} kW). Reduce fans or increase other load estimate.")
 else:
     st.success(f"✅ Fan power within budget (available: {max_fan_power_kw:.2f} kW).")
 
@@ -258,8 +339,9 @@ if st.button("Run Optimisation (single model)"):
     best_model = None
     best_qty = 0
     best_ach = 0
+    best_power = 0
     results = []
-    volume_ft3 = volume * 35.3147  # already computed
+    volume_ft3 = volume * FT3_PER_M3
 
     for model, data in FAN_DATABASE.items():
         # Maximum quantity based on power budget
@@ -269,7 +351,7 @@ if st.button("Run Optimisation (single model)"):
 
         # Find the smallest quantity that meets ACH
         # ACH = (qty * data["cfm"] * 60) / volume_ft3
-        required_qty_ach = max(1, int(np.ceil(SS_553_MIN_ACH * volume_ft3 / (data["cfm"] * 60))))
+        required_qty_ach = max(1, math.ceil(SS_553_MIN_ACH * volume_ft3 / (data["cfm"] * 60)))
         qty = min(required_qty_ach, max_qty_by_power)
 
         if qty == 0:
@@ -292,13 +374,14 @@ if st.button("Run Optimisation (single model)"):
                 best_ach = ach_achieved
                 best_model = model
                 best_qty = qty
+                best_power = power_used
 
     if results:
         df_results = pd.DataFrame(results)
         st.dataframe(df_results, use_container_width=True)
 
         if best_model:
-            st.success(f"**Recommended:** {best_qty} x {best_model} → ACH = {best_ach:.1f}, Power = {best_qty * FAN_DATABASE[best_model]['power_w'] / 1000:.2f} kW")
+            st.success(f"**Recommended:** {best_qty} x {best_model} → ACH = {best_ach:.1f}, Power = {best_power:.2f} kW")
         else:
             st.warning("No single fan model can meet both ACH and power limits. Consider a combination of models or reduce other loads.")
     else:
@@ -310,7 +393,7 @@ st.markdown(f"""
 **SP Approved Total Building Load:** {SP_APPROVED_LOAD_KVA} kVA  
 **Non‑fan load (your estimate):** {other_load:.1f} kW  
 **Available for fans:** {max_fan_power_kw:.1f} kW  
-**Current fan load:** {total_power/1000:.2f} kW  
+**Current fan load:** {total_power_kw:.2f} kW  
 
 *Note: Fan load is only part of the total building load. The overall electrical design (including lighting, outlets, etc.) must not exceed {SP_APPROVED_LOAD_KVA} kVA.*
 """)
@@ -345,7 +428,7 @@ for config in fan_configs:
     })
 st.dataframe(pd.DataFrame(fan_summary), use_container_width=True)
 
-# --- VISUALISATION (unchanged) ---
+# --- VISUALISATION ---
 st.subheader("📊 Airflow Visualization")
 
 if uploaded_image is not None:
@@ -354,10 +437,7 @@ if uploaded_image is not None:
         subplot_titles=("Simulated Airflow (After Analysis)", "Uploaded Floor Plan (Before)"),
         specs=[[{"type": "heatmap"}, {"type": "image"}]]
     )
-    heatmap = go.Heatmap(
-        z=V, x=np.linspace(0, width, int(width)), y=np.linspace(0, length, int(length)),
-        colorscale='Viridis', zmin=0, zmax=3, colorbar=dict(title="m/s")
-    )
+    heatmap = go.Heatmap(z=V, x=x_axis, y=y_axis, **VELOCITY_HEATMAP_STYLE)
     fig.add_trace(heatmap, row=1, col=1)
     from PIL import Image
     img = Image.open(uploaded_image)
@@ -365,82 +445,84 @@ if uploaded_image is not None:
     fig.update_layout(height=600, showlegend=False)
     st.plotly_chart(fig, use_container_width=True)
 else:
-    fig = go.Figure(data=go.Heatmap(
-        z=V, x=np.linspace(0, width, int(width)), y=np.linspace(0, length, int(length)),
-        colorscale='Viridis', zmin=0, zmax=3, colorbar=dict(title="m/s")
-    ))
-    fig.update_layout(title="Airflow Velocity Distribution", height=600)
+    fig = build_heatmap_figure(width, length, height, fan_configs, shape_type, **params)
     st.plotly_chart(fig, use_container_width=True)
 
 # Fan placement overlay
-if st.checkbox("Show Fan Placement"):
-    fig2 = go.Figure()
-    fig2.add_trace(go.Heatmap(
-        z=V, x=np.linspace(0, width, int(width)), y=np.linspace(0, length, int(length)),
-        colorscale='Viridis', zmin=0, zmax=3, showscale=False, opacity=0.7
-    ))
-    for fan in placed_fans:
-        model = fan["model"]
-        color = "red" if "8-Blade" in model else "blue"
-        fig2.add_trace(go.Scatter(
-            x=[fan["x"]], y=[fan["y"]],
-            mode='markers+text',
-            marker=dict(size=12, color=color, symbol='circle'),
-            text=model.split()[0],
-            textposition="top center",
-            name=model,
-            showlegend=False
+# A fragment, so toggling the overlay reruns only this section instead of the
+# whole script.
+@st.fragment
+def render_fan_placement(x_axis, y_axis, V, placed_fans):
+    if st.checkbox("Show Fan Placement"):
+        fig2 = go.Figure()
+        fig2.add_trace(go.Heatmap(
+            z=V, x=x_axis, y=y_axis, **VELOCITY_HEATMAP_STYLE, showscale=False, opacity=0.7
         ))
-    fig2.update_layout(
-        title="Fan Placement Overlay",
-        xaxis_title="Width (m)",
-        yaxis_title="Length (m)",
-        height=600
-    )
-    st.plotly_chart(fig2, use_container_width=True)
+        for fan in placed_fans:
+            model = fan["model"]
+            color = "red" if "8-Blade" in model else "blue"
+            fig2.add_trace(go.Scatter(
+                x=fan["x"], y=fan["y"],
+                mode='markers+text',
+                marker=dict(size=12, color=color, symbol='circle'),
+                text=model.split()[0],
+                textposition="top center",
+                name=model,
+                showlegend=False
+            ))
+        fig2.update_layout(
+            title="Fan Placement Overlay",
+            xaxis_title="Width (m)",
+            yaxis_title="Length (m)",
+            height=600
+        )
+        st.plotly_chart(fig2, use_container_width=True)
+
+render_fan_placement(x_axis, y_axis, V, placed_fans)
 
 # Recommendations from RFI
 st.subheader("📋 Recommendations from RFI")
-st.info("""
-- The location of HVLS fan shall be reviewed in conjunction with the lighting layout to prevent any throbbing effect.
-- Fan and lighting location shall not overlap.
-- Location and height to be reviewed and approved with architect.
-- 6-blade fans consume less power than 8-blade fans.
-- SP load upgrading may be required if total building load exceeds 1120 kVA.
-""")
+st.info("\n".join(f"- {rec}" for rec in RFI_RECOMMENDATIONS))
 
 # Download report
 if st.button("📥 Download Simulation Report"):
-    report = f"""TANGLIN HALT HAWKER CENTRE - AIRFLOW SIMULATION REPORT
-Generated on: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M')}
-
-CONFIGURATION:
-{chr(10).join([f"- {c['model']}: {c['quantity']} nos" for c in fan_configs])}
-
-RESULTS:
-- Floor Area: {actual_area:.1f} m²
-- Volume: {volume:.1f} m³
-- Total Airflow: {total_cfm:,.0f} CFM
-- Air Changes per Hour (ACH): {ach:.1f}
-- SS 553 Requirement: {SS_553_MIN_ACH} ACH
-- Compliance: {'PASS' if ach >= SS_553_MIN_ACH else 'FAIL'}
-
-POWER:
-- Non‑fan load (estimate): {other_load:.1f} kW
-- Fan Load: {total_power/1000:.2f} kW
-- Total Load: {other_load + total_power/1000:.2f} kW  (approx. kVA)
-- SP Approved Total Building Load: {SP_APPROVED_LOAD_KVA} kVA
-- Compliance: {'PASS' if (other_load + total_power/1000) <= SP_APPROVED_LOAD_KVA else 'FAIL'}
-
-RECOMMENDATIONS:
-- Review fan locations with lighting layout
-- Avoid overlapping fan and light positions
-- Obtain architect approval for final positions
-- Ensure total building load ≤ {SP_APPROVED_LOAD_KVA} kVA
-"""
+    now = pd.Timestamp.now()
+    total_load_kw = other_load + total_power_kw
+    lines = [
+        "TANGLIN HALT HAWKER CENTRE - AIRFLOW SIMULATION REPORT",
+        f"Generated on: {now.strftime('%Y-%m-%d %H:%M')}",
+        "",
+        "CONFIGURATION:",
+    ]
+    lines.extend(f"- {c['model']}: {c['quantity']} nos" for c in fan_configs)
+    lines += [
+        "",
+        "RESULTS:",
+        f"- Floor Area: {actual_area:.1f} m²",
+        f"- Volume: {volume:.1f} m³",
+        f"- Total Airflow: {total_cfm:,.0f} CFM",
+        f"- Air Changes per Hour (ACH): {ach:.1f}",
+        f"- SS 553 Requirement: {SS_553_MIN_ACH} ACH",
+        f"- Compliance: {'PASS' if ach >= SS_553_MIN_ACH else 'FAIL'}",
+        "",
+        "POWER:",
+        f"- Non‑fan load (estimate): {other_load:.1f} kW",
+        f"- Fan Load: {total_power_kw:.2f} kW",
+        f"- Total Load: {total_load_kw:.2f} kW  (approx. kVA)",
+        f"- SP Approved Total Building Load: {SP_APPROVED_LOAD_KVA} kVA",
+        f"- Compliance: {'PASS' if total_load_kw <= SP_APPROVED_LOAD_KVA else 'FAIL'}",
+        "",
+        "RECOMMENDATIONS:",
+        "- Review fan locations with lighting layout",
+        "- Avoid overlapping fan and light positions",
+        "- Obtain architect approval for final positions",
+        f"- Ensure total building load ≤ {SP_APPROVED_LOAD_KVA} kVA",
+        "",
+    ]
+    report = "\n".join(lines)
     st.download_button(
         label="Download Text Report",
         data=report,
-        file_name=f"airflow_report_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.txt",
+        file_name=f"airflow_report_{now.strftime('%Y%m%d_%H%M')}.txt",
         mime="text/plain"
     )